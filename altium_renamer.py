@@ -1,18 +1,47 @@
+import locale
+import mmap
 import os
 import re
 import sys
 
-def get_project_file(directory):
+# Patterns used by the project file parser and the filename templating,
+# compiled once instead of on every call / line.
+_PARAM_HDR_RE = re.compile(r'\[Parameter\d+\]')
+_NAME_RE = re.compile(r'Name=(.+)')
+_VALUE_RE = re.compile(r'Value=(.+)')
+_PLACEHOLDER_RE = re.compile(r'\[(.*?)\]')
+
+# Buffer size for reading parameters from the project file and for rewriting it.
+_PROJECT_FILE_BUFFER_SIZE = 1 << 20
+
+# Altium saves project files as ANSI, i.e. in the Windows locale code page (cp1252 on most
+# installs). locale.getencoding() reports that code page even when Python's UTF-8 mode is on;
+# it only exists from Python 3.11, before which getpreferredencoding() gives the same answer.
+# Decoding is strict, so a file in another encoding is rejected before anything is renamed.
+_PROJECT_FILE_ENCODING = getattr(locale, 'getencoding', lambda: locale.getpreferredencoding(False))()
+
+def scan_directory(directory):
+    """
+    Lists the entries of the given directory once, as os.DirEntry objects,
+    so that callers can share a single directory read.
+    """
+    with os.scandir(directory) as it:
+        return list(it)
+
+def get_project_file(directory, entries=None):
     """
     Finds the Altium project file (.PrjPcb, .PrjHar, .PrjMbd) in the given directory.
     Ensures there is exactly one project file.
+    If entries from scan_directory() are given, they are used instead of reading the directory again.
     """
     project_extensions = ('.PrjPcb', '.PrjHar', '.PrjMbd')
-    found_project_files = []
 
-    for filename in os.listdir(directory):
-        if filename.endswith(project_extensions):
-            found_project_files.append(os.path.abspath(os.path.join(directory, filename)))
+    if entries is None:
+        entries = scan_directory(directory)
+
+    # directory is expected to be absolute, so entry.path is already absolute
+    found_project_files = [entry.path for entry in entries
+                           if entry.name.endswith(project_extensions) and entry.is_file(follow_symlinks=False)]
 
     if len(found_project_files) == 0:
         return None, "Error: No Altium project file (.PrjPcb, .PrjHar, or .PrjMbd) found in the directory."
@@ -28,30 +57,36 @@ def extract_parameters_from_project_file(project_file_path):
     [ParameterX]
     Name=Abbreviation
     Value=LPIO
+    Returns None if the file cannot be decoded with the project file encoding.
     """
     parameters = {}
     current_parameter_name = None
 
     try:
-        with open(project_file_path, 'r') as f:
+        with open(project_file_path, 'r', encoding=_PROJECT_FILE_ENCODING, buffering=_PROJECT_FILE_BUFFER_SIZE) as f:
             for line in f:
                 line = line.strip()
 
-                if re.match(r'\[Parameter\d+\]', line):
+                if _PARAM_HDR_RE.match(line):
                     current_parameter_name = None
                     continue
 
-                name_match = re.match(r'Name=(.+)', line)
+                name_match = _NAME_RE.match(line)
                 if name_match:
-                    current_parameter_name = name_match.group(1).strip()
+                    # Interned to match the interned placeholder names generate_new_filename looks up,
+                    # once per placeholder in the project file name and in every templated filename
+                    current_parameter_name = sys.intern(name_match.group(1).strip())
                     continue
 
-                value_match = re.match(r'Value=(.+)', line)
+                value_match = _VALUE_RE.match(line)
                 if value_match and current_parameter_name:
                     parameters[current_parameter_name] = value_match.group(1).strip()
                     current_parameter_name = None
                     continue
 
+    except UnicodeDecodeError as e:
+        print(f"Error: Project file '{project_file_path}' is not valid {_PROJECT_FILE_ENCODING} text ({e}). Aborting.")
+        return None
     except FileNotFoundError:
         print(f"Error: Project file not found at '{project_file_path}' during parameter extraction. This should not happen if previous checks passed.")
     except Exception as e:
@@ -59,32 +94,26 @@ def extract_parameters_from_project_file(project_file_path):
 
     return parameters
 
-def get_placeholder_parameters_from_filename(filename):
-    """
-    Extracts all parameter names from a filename that are enclosed in square brackets.
-    E.g., "[PCBANumber]_[Abbreviation]_ASSY.PCBDwf" -> ["PCBANumber", "Abbreviation"]
-    """
-    return re.findall(r'\[(.*?)\]', filename)
-
 def generate_new_filename(old_filename_template, parameters):
     """
     Generates a new filename by replacing bracketed placeholders with their values.
     Returns the new filename and a list of missing parameters.
     """
+    if '[' not in old_filename_template:
+        return old_filename_template, [] # Nothing to substitute
+
     missing_params = []
-    new_filename = old_filename_template
 
-    placeholders = re.findall(r'(\[.*?\])', old_filename_template)
+    def substitute(match):
+        param_value = parameters.get(sys.intern(match.group(1)))
+        if param_value is None:
+            missing_params.append(match.group(1))
+            return match.group(0) # Leave the unresolved placeholder in place
+        return param_value
 
-    for placeholder in placeholders:
-        param_name = placeholder[1:-1]
-        param_value = parameters.get(param_name)
+    # One pass over the template; the regex drives which parameters are looked up
+    new_filename = _PLACEHOLDER_RE.sub(substitute, old_filename_template)
 
-        if param_value is not None:
-            new_filename = new_filename.replace(placeholder, param_value)
-        else:
-            missing_params.append(param_name)
-    
     return new_filename, missing_params
 
 def rename_files_and_update_project(directory):
@@ -92,34 +121,43 @@ def rename_files_and_update_project(directory):
     Renames files in the directory that match a pattern like [Parameter]_...
     and updates the project file based on parameters extracted from the project file itself.
     """
+    # Read the directory once; the same entries serve the project file lookup and Step 1.
+    # Only the project file is renamed in between, and Step 1 skips it by name either way.
+    entries_on_disk = scan_directory(directory)
+
     # 1. Get the ABSOLUTE path to the project file
-    project_file_path, error_message = get_project_file(directory)
+    project_file_path, error_message = get_project_file(directory, entries_on_disk)
     if error_message:
         print(error_message)
         return
 
-    original_project_file_basename = os.path.basename(project_file_path)
+    # Split the path once; project_file_basename tracks the current name through the rename
+    project_file_directory, original_project_file_basename = os.path.split(project_file_path)
+    project_file_basename = original_project_file_basename
     
-    # Extract parameters from the project file to get values for its own name if it's templated
-    project_params_for_name = extract_parameters_from_project_file(project_file_path)
+    # --- Step 0: Extract all parameters from the project file ---
+    # Done once, before any renaming: they give values for its own name if it's templated,
+    # and renaming the file on disk does not change its contents.
+    print("--- Extracting parameters from project file ---")
+    all_extracted_parameters = extract_parameters_from_project_file(project_file_path)
+    if all_extracted_parameters is None:
+        return # Undecodable project file, already reported; nothing has been renamed yet
 
     project_file_new_basename, missing_project_params = generate_new_filename(
         original_project_file_basename,
-        project_params_for_name
+        all_extracted_parameters
     )
 
-    new_project_file_absolute_path = project_file_path # Initialize with current path
-    
     if project_file_new_basename != original_project_file_basename:
         # The project file itself needs renaming!
         if missing_project_params:
             print(f"Error: Project file name '{original_project_file_basename}' has missing parameters: {', '.join(missing_project_params)}. Cannot rename project file. Aborting.")
             return
         
-        new_project_file_absolute_path = os.path.join(os.path.dirname(project_file_path), project_file_new_basename)
+        new_project_file_absolute_path = os.path.join(project_file_directory, project_file_new_basename)
         
         if os.path.exists(new_project_file_absolute_path) and new_project_file_absolute_path != project_file_path:
-            print(f"Warning: New project file name '{os.path.basename(new_project_file_absolute_path)}' already exists. Cannot rename project file. Aborting.")
+            print(f"Warning: New project file name '{project_file_new_basename}' already exists. Cannot rename project file. Aborting.")
             return
             
         try:
@@ -127,18 +165,18 @@ def rename_files_and_update_project(directory):
             print(f"Renamed project file from '{original_project_file_basename}' to '{project_file_new_basename}'.")
             # Update project_file_path to the new path so all subsequent operations use it
             project_file_path = new_project_file_absolute_path
+            project_file_basename = project_file_new_basename
         except OSError as e:
             print(f"Error renaming project file from '{original_project_file_basename}': {e}. Aborting.")
             return
 
-    print(f"Operating on Altium project file: {os.path.basename(project_file_path)}")
-
-    # --- Step 0: Extract all parameters from the project file (now using its potentially new name) ---
-    print("\n--- Extracting parameters from project file ---")
-    all_extracted_parameters = extract_parameters_from_project_file(project_file_path)
+    print(f"Operating on Altium project file: {project_file_basename}")
 
     if not all_extracted_parameters:
+        # Every templated file would be skipped for missing parameters, and the project file
+        # cannot have been renamed either, so there is nothing for Step 1 or Step 2 to do.
         print("Warning: No parameters found in the project file. No files will be renamed based on parameters.")
+        return
 
     # This map will store the ORIGINAL FILENAME AS FOUND ON DISK (which might be the template name)
     # to the NEW ACTUAL FILENAME AFTER RENAMING.
@@ -149,26 +187,24 @@ def rename_files_and_update_project(directory):
     # --- Step 1: Identify and rename other files ---
     print("\n--- Identifying and renaming other files ---")
     
-    current_files_on_disk = os.listdir(directory)
-    
-    for filename_on_disk in current_files_on_disk:
-        full_path_on_disk = os.path.join(directory, filename_on_disk)
-        
-        if not os.path.isfile(full_path_on_disk):
-            continue # Skip directories
+    # The project file under its original and its new name (the same name if it was not renamed)
+    project_file_names_to_skip = frozenset((original_project_file_basename, project_file_new_basename))
 
-        # Skip the project file itself here, as its renaming was handled above
-        if full_path_on_disk == project_file_path or \
-           (project_file_new_basename != original_project_file_basename and filename_on_disk == original_project_file_basename):
-            # This handles the case where project file was renamed (skip new name)
-            # or was not renamed but is still the original project file (skip original name)
-            continue
+    for entry in entries_on_disk:
+        filename_on_disk = entry.name
+        if '[' not in filename_on_disk:
+            continue # Not templated, skip before any stat or regex work
+
+        full_path_on_disk = entry.path
 
-        placeholders_in_filename = get_placeholder_parameters_from_filename(filename_on_disk)
+        if not entry.is_file():
+            continue # Skip directories (DirEntry caches the stat result)
 
-        if not placeholders_in_filename:
-            continue # Not a file we need to process based on parameters
+        # Skip the project file itself here, as its renaming was handled above
+        if filename_on_disk in project_file_names_to_skip:
+            continue
 
+        # One regex pass both substitutes the placeholders and collects the missing ones
         new_filename_candidate, missing_params = generate_new_filename(filename_on_disk, all_extracted_parameters)
 
         if missing_params:
@@ -180,16 +216,16 @@ def rename_files_and_update_project(directory):
             new_filepath = os.path.join(directory, new_filename_candidate)
 
             if os.path.exists(new_filepath) and new_filepath != old_filepath:
-                print(f"Warning: New file '{os.path.basename(new_filepath)}' already exists. Skipping rename for '{filename_on_disk}'.")
+                print(f"Warning: New file '{new_filename_candidate}' already exists. Skipping rename for '{filename_on_disk}'.")
                 continue
 
             try:
                 os.rename(old_filepath, new_filepath)
-                print(f"Renamed '{filename_on_disk}' to '{os.path.basename(new_filepath)}'")
+                print(f"Renamed '{filename_on_disk}' to '{new_filename_candidate}'")
                 
                 # Store the original filename (which might be the template name)
                 # and the new actual name for updating references in the project file.
-                files_renamed_map[filename_on_disk] = os.path.basename(new_filepath)
+                files_renamed_map[filename_on_disk] = new_filename_candidate
             except OSError as e:
                 print(f"Error renaming '{filename_on_disk}': {e}")
 
@@ -206,75 +242,59 @@ def rename_files_and_update_project(directory):
         print("No files were renamed or had their templates resolved, so no DocumentPath updates are necessary.")
         return
 
-    try:
-        with open(project_file_path, 'r') as f:
-            lines = f.readlines() # Read line by line to modify specific lines
-
-        updated_lines = []
-        changes_made_in_content = False
-
-        for line in lines:
-            modified_line = line
-            # Check if the line starts with 'DocumentPath='
-            if line.strip().startswith('DocumentPath='):
-                # Extract the path portion (everything after 'DocumentPath=')
-                path_part = line.strip().split('=', 1)[1]
-                
-                # Extract just the filename from the path
-                current_filename_in_path = os.path.basename(path_part)
-                
-                # Look for this filename in our map of renamed files
-                new_filename_for_path = files_renamed_map.get(current_filename_in_path)
-
-                if new_filename_for_path and new_filename_for_path != current_filename_in_path:
-                    # Replace the old filename with the new filename in the path part
-                    # Ensure we preserve the directory structure if any (though usually just filename in PrjXXX)
-                    # For simplicity, assuming DocumentPath=filename.ext or DocumentPath=path\filename.ext
-                    
-                    # More robust replacement using regex to preserve surrounding path
-                    # This captures the DocumentPath= prefix and any path before the filename.
-                    # It matches the old filename and replaces only that part.
-                    # This regex handles cases like:
-                    #   DocumentPath=filename.ext
-                    #   DocumentPath=SubFolder\filename.ext
-                    #   DocumentPath=..\SubFolder\filename.ext
-                    
-                    # Escape the current_filename_in_path for safe regex use
-                    pattern_filename_escaped = re.escape(current_filename_in_path)
-                    
-                    # Pattern to find 'DocumentPath=' followed by any characters (non-greedy)
-                    # then the old filename, then the rest of the line.
-                    # We capture the parts we want to keep.
-                    
-                    # This needs to be carefully constructed. It should find
-                    # "DocumentPath=" and then the OLD filename.
-                    # Let's rebuild the regex for the replacement.
-                    
-                    # The value of `path_part` is often just the filename itself,
-                    # but it could contain a relative path.
-                    # The most straightforward way is to replace `current_filename_in_path`
-                    # with `new_filename_for_path` *within* the `path_part` string,
-                    # then reconstruct the line.
-                    
-                    new_path_part = path_part.replace(current_filename_in_path, new_filename_for_path)
-                    modified_line = f"DocumentPath={new_path_part}\n" # Reconstruct the line
-                    
-                    # Only mark changes if the line actually changed
-                    if modified_line.strip() != line.strip():
-                        changes_made_in_content = True
-                        print(f"  Updated DocumentPath: '{line.strip()}' -> '{modified_line.strip()}'")
-            
-            updated_lines.append(modified_line)
+    # One alternation regex over every renamed name (longest first, so a name that is a
+    # prefix of another cannot win), matched only as the last path component of a
+    # DocumentPath= line. This handles cases like:
+    #   DocumentPath=filename.ext
+    #   DocumentPath=SubFolder\filename.ext
+    #   DocumentPath=..\SubFolder\filename.ext
+    # It works on the raw bytes, so the file is never decoded and its line endings are kept as is.
+    # The names are encoded with the same code page the parameters were read with.
+    encoded_renamed_map = {}
+    for old_name, new_name in files_renamed_map.items():
+        try:
+            encoded_renamed_map[old_name.encode(_PROJECT_FILE_ENCODING)] = new_name.encode(_PROJECT_FILE_ENCODING)
+        except UnicodeEncodeError:
+            print(f"Warning: '{old_name}' -> '{new_name}' cannot be represented in the project file's {_PROJECT_FILE_ENCODING} encoding. Its DocumentPath reference was not updated.")
 
-        if changes_made_in_content:
-            with open(project_file_path, 'w') as f:
-                f.writelines(updated_lines)
-            print(f"Successfully wrote updated content to '{os.path.basename(project_file_path)}'.")
+    if not encoded_renamed_map:
+        print(f"No DocumentPath changes could be made in '{project_file_basename}'.")
+        return
+
+    renamed_names_alternation = b'|'.join(
+        re.escape(old_name) for old_name in sorted(encoded_renamed_map, key=len, reverse=True)
+    )
+    document_path_pattern = re.compile(
+        rb'^([ \t]*DocumentPath=(?:[^\r\n]*[\\/])?)(' + renamed_names_alternation + rb')(?=[ \t\r]*$)',
+        re.MULTILINE
+    )
+
+    def update_document_path(match):
+        updated = match.group(1) + encoded_renamed_map[match.group(2)]
+        print(f"  Updated DocumentPath: '{match.group(0).decode(_PROJECT_FILE_ENCODING, 'replace').strip()}' -> '{updated.decode(_PROJECT_FILE_ENCODING, 'replace').strip()}'")
+        return updated
+
+    try:
+        updated_content = None
+
+        with open(project_file_path, 'rb') as f:
+            # mmap cannot map an empty file, and an empty file has nothing to update anyway
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # Scan first: when no DocumentPath needs changing, nothing is copied or written
+                    if document_path_pattern.search(mm):
+                        updated_content = document_path_pattern.sub(update_document_path, mm)
+
+        # The mapping is closed before rewriting, which Windows requires
+        if updated_content is not None:
+            with open(project_file_path, 'wb', buffering=_PROJECT_FILE_BUFFER_SIZE) as f:
+                f.write(updated_content)
+            print(f"Successfully wrote updated content to '{project_file_basename}'.")
         else:
-            print(f"No DocumentPath changes were needed in '{os.path.basename(project_file_path)}'.")
+            print(f"No DocumentPath changes were needed in '{project_file_basename}'.")
 
     except Exception as e:
-        print(f"Error updating project file content '{os.path.basename(project_file_path)}': {e}")
+        print(f"Error updating project file content '{project_file_basename}': {e}")
 
 
 if __name__ == "__main__":